@@ -11,10 +11,18 @@ resulting dataframe back down to disk as a .csv file.
 
 This light processing is needed so that we can use the resulting .csv file as the data source for our 
 Streamlit Spotify dashboard. 
+
+The SpotData class also holds all the queries behind the dashboard charts. By default these run in pandas, 
+but SpotData(backend='duckdb') instead scans the json and csv files lazily with DuckDB, so the queries are 
+pushed down to a multi-threaded engine and the full play history never has to fit in memory. Both backends 
+return identical results (run this file directly to check). 
 """
 
 import pandas as pd
+import numpy as np
 from pathlib import Path
+from datetime import date
+import os
 import json
 import matplotlib.pyplot as plt
 
@@ -22,13 +30,76 @@ import matplotlib.pyplot as plt
 PATH_TO_THIS_FILE: Path = Path(__file__).resolve()
 ABSPATH_TO_DATA: Path = PATH_TO_THIS_FILE.parent / "MyData"
 ABSPATH_TO_CREDENTIALS: Path = PATH_TO_THIS_FILE.parent.parent / "spotify_app_credentials.json"
+ABSPATH_TO_AUDIO_FEATURES: Path = ABSPATH_TO_DATA / 'audio_features' / 'audio_features_final.csv'
+ABSPATH_TO_SEARCH_QUERIES: Path = ABSPATH_TO_DATA / 'SearchQueries.json'
+ABSPATH_TO_HISTORY_PARQUET: Path = ABSPATH_TO_DATA / 'streaming_history.parquet'
+
+# the query engines that SpotData can run the dashboard aggregations on 
+QUERY_BACKENDS: tuple = ('pandas', 'duckdb')
+
+# all the 15 minute time slots in a day, used for the daily listening pattern
+TIME_SLOTS: list = [f'{h:02d}:{m:02d}:00' for h in range(24) for m in range(0, 60, 15)]
+
+
+def streaming_history_files() -> list:
+    """
+    Function to list the StreamingHistory json files that make up the full streaming history
+
+    :param: NA 
+    :return: list of absolute paths (as strings) to each StreamingHistory file 
+    """
+    # TODO iterate through all the files that start with "streaming"
+    return [str(ABSPATH_TO_DATA / f'StreamingHistory{file_number}.json') for file_number in [0, 1, 2]]
+
+
+def write_parquet(con, select_sql: str, sources: list, target: Path):
+    """
+    Function to write the result of a DuckDB query to a parquet file, unless the file is already newer than all 
+    of its sources. Parquet is columnar, so later queries only read the columns they need instead of parsing 
+    every row of the json and csv files again. 
+
+    :param: con - duckdb connection 
+    :param: select_sql - the query to write to disk 
+    :param: sources - list of paths to the files the query reads from 
+    :param: target - path to the parquet file 
+    :return: NA 
+    """
+    if target.exists() and target.stat().st_mtime >= max(Path(f).stat().st_mtime for f in sources):
+        return
+
+    # write to a temporary file first so that a half written parquet file is never picked up 
+    tmp_target: Path = target.with_suffix('.parquet.tmp')
+    con.execute(f"COPY ({select_sql}) TO '{tmp_target}' (FORMAT PARQUET)")
+    os.replace(tmp_target, target)
+
+
+def season_filter(df: pd.DataFrame, season_months: list) -> pd.DataFrame:
+    """
+    Function to filter a dataframe down to the months in a given season
+
+    :param: df - pandas dataframe containing the 'date_filter' datetime column 
+    :param: season_months - list of the months (1-12) to keep 
+    :return: the filtered dataframe 
+    """
+    return df[df['date_filter'].dt.month.isin(season_months)]
 
 
 class SpotData():
 
-    def __init__(self):
-        self.streaming_history = self.read_streaming_history()
+    def __init__(self, backend: str = 'pandas'):
+        if backend not in QUERY_BACKENDS:
+            raise ValueError(f'Unknown query backend: {backend}, choose one of {QUERY_BACKENDS}')
+        self.backend = backend
         self.library = self.read_library()
+        self._audio_features = None
+        self._search_queries = None
+
+        if self.backend == 'duckdb':
+            # the streaming history is never read into memory here, DuckDB scans a parquet copy of it on each query
+            self.streaming_history = None
+            self.con = self.connect_duckdb()
+        else:
+            self.streaming_history = self.read_streaming_history()
 
     def read_streaming_history(self) -> pd.DataFrame:
         """
@@ -40,11 +111,8 @@ class SpotData():
 
         dfs = []
         # iterate over each StreamingHistory file in the directory and read them into a pandas dataframe
-        # TODO iterate through all the files that start with "streaming"
-        for file_number in [0, 1, 2]:
-            fname: str = f'StreamingHistory{file_number}.json'
-            abspath_to_file: Path = ABSPATH_TO_DATA / fname
-            df: pd.DataFrame = pd.read_json(str(abspath_to_file))
+        for abspath_to_file in streaming_history_files():
+            df: pd.DataFrame = pd.read_json(abspath_to_file)
             # add the single dataframe to the list outside the loop so we can concatenate it later 
             dfs.append(df)
 
@@ -54,6 +122,9 @@ class SpotData():
         # add a unique key for each song which is the string concatenation of the 'artist' + 'song' 
         streaming_data['artist_and_song'] = streaming_data['artistName'] + ' - ' + streaming_data['trackName']
 
+        # we need to convert the string datetime series to a pandas datetime column so we can filter by season 
+        streaming_data['date_filter'] = pd.to_datetime(streaming_data['endTime'], format='%Y-%m-%d %H:%M')
+
         return streaming_data
 
 
@@ -88,6 +159,296 @@ class SpotData():
         return df
 
 
+    def read_search_queries(self) -> pd.DataFrame:
+        """
+        Function to read the SearchQueries json file as a pandas dataframe
+        
+        :param: NA 
+        :return: pandas dataframe containing every search made by the Spotify user, sorted by 'searchTime' 
+        """
+
+        df: pd.DataFrame = pd.read_json(str(ABSPATH_TO_SEARCH_QUERIES), dtype={'searchQuery': str})
+
+        # the search times look like '2021-12-18T21:59:53.972Z[UTC]', so we drop the zone suffix and parse them as UTC 
+        # (the same time zone as the 'endTime' column in the streaming history) 
+        df['searchTime'] = pd.to_datetime(df['searchTime'].str.replace('[UTC]', '', regex=False), 
+                                          format='%Y-%m-%dT%H:%M:%S.%fZ')
+
+        # sort by time and give each search a unique id so that plays can be linked back to it 
+        df = df.sort_values(by='searchTime', kind='mergesort').reset_index(drop=True)
+        df['search_id'] = df.index
+
+        return df
+
+
+    def connect_duckdb(self):
+        """
+        Function to open an in-memory DuckDB connection and register the streaming history as a lazily scanned view
+        
+        :param: NA 
+        :return: duckdb connection with the 'plays' view and the 'library' table 
+        """
+        # duckdb is only needed for this backend, so we only import it here 
+        import duckdb
+
+        con = duckdb.connect(database=':memory:')
+
+        # convert the json files to parquet once, the column types are given explicitly so that DuckDB doesn't try 
+        # to auto-detect endTime as a timestamp 
+        files: str = ', '.join(f"'{f}'" for f in streaming_history_files())
+        write_parquet(con, f"""
+            SELECT *, 
+                artistName || ' - ' || trackName AS artist_and_song, 
+                strptime(endTime, '%Y-%m-%d %H:%M') AS ts 
+            FROM read_json([{files}], format='array', 
+                columns={{'endTime': 'VARCHAR', 'artistName': 'VARCHAR', 'trackName': 'VARCHAR', 'msPlayed': 'BIGINT'}})
+        """, streaming_history_files(), ABSPATH_TO_HISTORY_PARQUET)
+        con.execute(f"CREATE VIEW plays AS SELECT * FROM read_parquet('{ABSPATH_TO_HISTORY_PARQUET}')")
+
+        # the library is tiny, so we can just copy the pandas dataframe into a table 
+        con.register('library_df', self.library)
+        con.execute('CREATE TABLE library AS SELECT * FROM library_df')
+        con.unregister('library_df')
+
+        return con
+
+
+    def query(self, sql: str, params: list) -> pd.DataFrame:
+        """
+        Function to run a query on the DuckDB backend. Each query gets its own cursor so that one SpotData object 
+        can be shared between streamlit sessions running in different threads. 
+        
+        :param: sql - the query to run 
+        :param: params - list of values for the ? placeholders in the query 
+        :return: pandas dataframe containing the query result 
+        """
+        return self.con.cursor().execute(sql, params).df()
+
+
+    def audio_features(self):
+        """
+        Function to lazily load the audio features, these only exist after get_audio_features.py has been run
+        
+        :param: NA 
+        :return: pandas dataframe for the pandas backend, for the duckdb backend the name of the registered view 
+        """
+        if self._audio_features is None:
+            if self.backend == 'duckdb':
+                # convert the csv to parquet once, the first column is just the pandas index so we leave it out 
+                features_parquet: Path = ABSPATH_TO_AUDIO_FEATURES.with_suffix('.parquet')
+                write_parquet(self.con, f"""
+                    SELECT endTime, artistName, trackName, msPlayed, artist_and_song, energy, loudness, danceability, 
+                        genres, strptime(endTime, '%Y-%m-%d %H:%M') AS ts 
+                    FROM read_csv_auto('{ABSPATH_TO_AUDIO_FEATURES}', header=true, types={{'endTime': 'VARCHAR'}})
+                """, [ABSPATH_TO_AUDIO_FEATURES], features_parquet)
+                self.con.execute(f"CREATE VIEW features AS SELECT * FROM read_parquet('{features_parquet}')")
+                self._audio_features = 'features'
+            else:
+                df: pd.DataFrame = load_audio_features()
+                # parse the dates once here so that every query can filter by season 
+                df['date_filter'] = pd.to_datetime(df['endTime'], format='%Y-%m-%d %H:%M')
+                self._audio_features = df
+
+        return self._audio_features
+
+
+    def search_queries(self) -> pd.DataFrame:
+        """
+        Function to lazily load the search queries, not every Spotify export includes SearchQueries.json
+        
+        :param: NA 
+        :return: pandas dataframe containing every search made by the Spotify user 
+        """
+        if self._search_queries is None:
+            self._search_queries = self.read_search_queries()
+            if self.backend == 'duckdb':
+                # the searches are small, so we can just copy the pandas dataframe into a table 
+                self.con.register('searches_df', self._search_queries[['search_id', 'searchTime', 'searchQuery']])
+                self.con.execute('CREATE TABLE searches AS SELECT * FROM searches_df')
+                self.con.unregister('searches_df')
+
+        return self._search_queries
+
+
+    def top_n(self, key: str, n: int, season_months: list, features: bool = False) -> pd.DataFrame:
+        """
+        Function to find the most played values of a column (songs, artists, genres) in the given season
+        
+        :param: key - column to group by, e.g. 'artist_and_song', 'artistName', or 'genres' 
+        :param: n - number of rows to return 
+        :param: season_months - list of the months (1-12) to include 
+        :param: features - bool, set to true to query the audio features instead of the streaming history 
+        :return: pandas dataframe containing the columns [key, 'Count'] sorted by 'Count' 
+        """
+        if self.backend == 'duckdb':
+            table: str = self.audio_features() if features else 'plays'
+            return self.query(f"""
+                SELECT "{key}", count(endTime) AS Count 
+                FROM {table} 
+                WHERE list_contains(?, month(ts)) AND "{key}" IS NOT NULL 
+                GROUP BY "{key}" 
+                ORDER BY Count DESC, "{key}" ASC 
+                LIMIT {int(n)}
+            """, [season_months])
+
+        df: pd.DataFrame = self.audio_features() if features else self.streaming_history
+        df = season_filter(df, season_months)
+        counts_df = df.groupby(by=[key])['endTime'].count().rename('Count').reset_index()
+        # we break ties on the key so that the order is the same on every backend 
+        counts_df = counts_df.sort_values(by=['Count', key], ascending=[False, True])
+        return counts_df.head(n).reset_index(drop=True)
+
+
+    def listening_pattern(self, season_months: list) -> pd.DataFrame:
+        """
+        Function to count the songs played in each 15 minute time slot of the day in the given season
+        
+        :param: season_months - list of the months (1-12) to include 
+        :return: pandas dataframe containing the columns ['time', 'msPlayed'] with one row for each time slot 
+        """
+        if self.backend == 'duckdb':
+            counts_df = self.query("""
+                SELECT printf('%02d:%02d:00', hour(ts), (minute(ts) // 15) * 15) AS time, 
+                    count(msPlayed) AS msPlayed 
+                FROM plays 
+                WHERE list_contains(?, month(ts)) 
+                GROUP BY 1 
+            """, [season_months])
+            counts = counts_df.set_index('time')['msPlayed']
+        else:
+            df = season_filter(self.streaming_history, season_months)
+            df = df[df['msPlayed'].notna()]
+            counts = df['date_filter'].dt.floor('15Min').dt.strftime('%H:%M:%S').value_counts()
+
+        # time slots without any plays still need to show up in the chart 
+        counts = counts.reindex(TIME_SLOTS, fill_value=0).astype('int64')
+        return pd.DataFrame({'time': TIME_SLOTS, 'msPlayed': counts.values})
+
+
+    def feature_rollup(self, freq: str, season_months: list, exclude_year: int = None) -> pd.DataFrame:
+        """
+        Function to find the mean energy, loudness, and danceability for each day, week, or month in the given season
+        
+        :param: freq - pandas frequency string, one of 'D', 'W', or 'M' 
+        :param: season_months - list of the months (1-12) to include 
+        :param: exclude_year - optional year to leave out of the rollup 
+        :return: pandas dataframe with a datetime index covering every period, empty periods are NaN 
+        """
+        columns: list = ['energy', 'loudness', 'danceability']
+
+        if self.backend == 'duckdb':
+            # these match the period labels pandas uses: days, weeks ending on Sunday, and month ends 
+            period_mapper: dict = {
+                'D': 'CAST(ts AS DATE)', 
+                'W': 'CAST(ts AS DATE) + CAST((7 - isodow(ts)) % 7 AS INTEGER)', 
+                'M': 'last_day(ts)'
+            }
+            year_filter: str = '' if exclude_year is None else f'AND year(ts) != {int(exclude_year)}'
+            rollup_df = self.query(f"""
+                SELECT {period_mapper[freq]} AS period, avg(energy) AS energy, 
+                    avg(loudness) AS loudness, avg(danceability) AS danceability 
+                FROM {self.audio_features()} 
+                WHERE list_contains(?, month(ts)) {year_filter} 
+                GROUP BY 1 
+                ORDER BY 1 
+            """, [season_months])
+            rollup_df.index = pd.DatetimeIndex(pd.to_datetime(rollup_df['period']))
+            rollup_df = rollup_df[columns]
+        else:
+            df = season_filter(self.audio_features(), season_months)
+            if exclude_year is not None:
+                df = df[df['date_filter'].dt.year != exclude_year]
+            df = df.set_index('date_filter')[columns]
+            rollup_df = df.groupby(pd.Grouper(freq=freq)).mean()
+
+        # periods without any plays still need to show up in the chart 
+        if len(rollup_df) > 0:
+            rollup_df = rollup_df.reindex(pd.date_range(start=rollup_df.index.min(), end=rollup_df.index.max(), freq=freq))
+        return rollup_df.rename_axis(None)
+
+
+    def taste(self, season_months: list, threshold: float, n: int = 20) -> pd.DataFrame:
+        """
+        Function to find the songs in the library that get skipped the fastest in the given season
+        
+        :param: season_months - list of the months (1-12) to include 
+        :param: threshold - only songs with a mean msPlayed above this are kept 
+        :param: n - number of rows to return 
+        :return: pandas dataframe containing the columns ['artist_and_song', 'msPlayed'] sorted by 'msPlayed' 
+        """
+        if self.backend == 'duckdb':
+            return self.query(f"""
+                SELECT artist_and_song, avg(msPlayed) AS msPlayed 
+                FROM plays 
+                WHERE list_contains(?, month(ts)) 
+                    AND artist_and_song IN (SELECT artist_and_song FROM library) 
+                GROUP BY artist_and_song 
+                HAVING avg(msPlayed) > ? 
+                ORDER BY msPlayed ASC, artist_and_song ASC 
+                LIMIT {int(n)}
+            """, [season_months, threshold])
+
+        df = season_filter(self.streaming_history, season_months)
+        df = df[df['artist_and_song'].isin(self.library['artist_and_song'])]
+        taste_df = df.groupby(['artist_and_song'])['msPlayed'].mean().reset_index()
+        # here we want to exclude all the songs that were'nt played at all because they were never forcibly skipped 
+        taste_df = taste_df[taste_df['msPlayed'] > threshold]
+        taste_df = taste_df.sort_values(by=['msPlayed', 'artist_and_song'], ascending=True)
+        return taste_df.head(n).reset_index(drop=True)
+
+
+    def search_conversions(self, season_months: list, window_minutes: int) -> pd.DataFrame:
+        """
+        Function to link each play to the most recent search made at most window_minutes before the play started, 
+        and then find the searches that were followed by listening. A play starts msPlayed before its endTime, so 
+        a song that was already playing when the search was made is never counted towards it. endTime is rounded 
+        down to the minute, so we use the latest possible start (endTime + 59.999 seconds - msPlayed), otherwise a 
+        song started right after a search could look like it started before it. This is an as-of join on the sorted search times, so it scales 
+        with (searches + plays) log(searches) instead of comparing every search against every play. 
+        
+        :param: season_months - list of the months (1-12) to include 
+        :param: window_minutes - how many minutes after a search a play still counts towards it 
+        :return: pandas dataframe containing the columns ['searchTime', 'searchQuery', 'Plays', 'msPlayed'] with 
+                 one row for each search that led to at least one play, sorted by 'searchTime' 
+        """
+        searches = self.search_queries()
+
+        if self.backend == 'duckdb':
+            return self.query(f"""
+                WITH matched AS (
+                    SELECT s.search_id, p.msPlayed 
+                    FROM (SELECT ts + INTERVAL 59999 MILLISECOND - to_milliseconds(msPlayed) AS start_ts, msPlayed FROM plays 
+                          WHERE list_contains(?, month(ts))) p 
+                    ASOF JOIN (SELECT search_id, searchTime FROM searches WHERE list_contains(?, month(searchTime))) s 
+                        ON p.start_ts >= s.searchTime 
+                    WHERE p.start_ts - s.searchTime <= INTERVAL {int(window_minutes)} MINUTE 
+                ) 
+                SELECT s.searchTime, s.searchQuery, count(m.msPlayed) AS Plays, sum(m.msPlayed) AS msPlayed 
+                FROM matched m 
+                JOIN searches s ON m.search_id = s.search_id 
+                GROUP BY s.search_id, s.searchTime, s.searchQuery 
+                ORDER BY s.searchTime ASC, s.search_id ASC 
+            """, [season_months, season_months])
+
+        plays = season_filter(self.streaming_history, season_months)
+        plays = plays.assign(start_time=plays['date_filter'] + pd.Timedelta(milliseconds=59999) 
+                                        - pd.to_timedelta(plays['msPlayed'], unit='ms'))
+        plays = plays[['start_time', 'msPlayed']].sort_values(by='start_time', kind='mergesort')
+        searches = searches[searches['searchTime'].dt.month.isin(season_months)]
+
+        # each play picks up the last search before it started, as long as that search is inside the time window 
+        matched = pd.merge_asof(plays, searches[['searchTime', 'search_id']], left_on='start_time', 
+                                right_on='searchTime', direction='backward', 
+                                tolerance=pd.Timedelta(minutes=window_minutes))
+        matched = matched.dropna(subset=['search_id'])
+        matched['search_id'] = matched['search_id'].astype('int64')
+
+        conversions = matched.groupby('search_id').agg(Plays=('msPlayed', 'count'), msPlayed=('msPlayed', 'sum'))
+        conversions_df = searches.merge(conversions.reset_index(), on='search_id', how='inner')
+        conversions_df = conversions_df.sort_values(by=['searchTime', 'search_id'])
+        return conversions_df[['searchTime', 'searchQuery', 'Plays', 'msPlayed']].reset_index(drop=True)
+
+
 def barchart(df: pd.DataFrame):
     """
     Little function to create a nice bar chart in matplotlib
@@ -127,14 +488,178 @@ def barchart(df: pd.DataFrame):
     return (fig, ax)
 
 
+def lttb(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    """
+    Largest-Triangle-Three-Buckets downsampling. The points are split into n_out - 2 buckets and from each bucket 
+    we keep the point that makes the largest triangle with the point kept from the previous bucket and the average 
+    of the next bucket. This keeps the peaks and the overall shape of a line with far fewer points. 
+
+    :param: x - numeric numpy array of x values, sorted ascending 
+    :param: y - numeric numpy array of y values, NaN values are treated as gaps in the line 
+    :param: n_out - the number of points to keep 
+    :return: numpy array of the indices of the points to keep 
+    """
+    n: int = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    x = x.astype(float)
+    y = y.astype(float)
+
+    # only the real points are downsampled, and we keep the first NaN of each gap so that plotly still breaks the line 
+    is_gap = np.isnan(y)
+    if is_gap.any():
+        gap_starts = np.flatnonzero(is_gap & np.concatenate([[True], ~is_gap[:-1]]))
+        real = np.flatnonzero(~is_gap)
+        keep = real[lttb(x[real], y[real], max(n_out - len(gap_starts), 3))]
+        return np.sort(np.concatenate([keep, gap_starts]))
+
+    bucket_size: float = (n - 2) / (n_out - 2)
+
+    # we always keep the first and last points 
+    indices = np.zeros(n_out, dtype=np.int64)
+    indices[-1] = n - 1
+    a: int = 0
+    for i in range(n_out - 2):
+        start: int = int(i * bucket_size) + 1
+        end: int = int((i + 1) * bucket_size) + 1
+        # the next bucket is averaged into a single point, the last bucket is followed only by the last point 
+        next_end: int = min(int((i + 2) * bucket_size) + 1, n)
+        avg_x: float = x[end:next_end].mean()
+        avg_y: float = y[end:next_end].mean()
+
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(area))
+        indices[i + 1] = a
+
+    return indices
+
+
+def prepare_figure(fig, width: int, points_per_pixel: float = 2.0):
+    """
+    Function to shrink a plotly figure before it gets sent to the browser. Line traces with numeric y values that 
+    are longer than the point budget for the chart width are downsampled with LTTB, every other trace is left as is. 
+
+    :param: fig - plotly figure 
+    :param: width - width of the chart in pixels, the layout width is used instead if the figure has one 
+    :param: points_per_pixel - how many points per pixel of chart width to keep for each line 
+    :return: the same plotly figure, updated in place 
+    """
+    budget: int = int((fig.layout.width or width) * points_per_pixel)
+
+    for trace in fig.data:
+        if trace.type not in ('scatter', 'scattergl') or trace.x is None or trace.y is None or len(trace.x) <= budget:
+            continue
+        # markers-only scatters need every point, plotly draws long traces as lines when no mode is given 
+        if trace.mode is not None and 'lines' not in trace.mode:
+            continue
+        x = np.asarray(trace.x)
+        y = np.asarray(trace.y)
+        if y.dtype.kind not in 'iuf':
+            continue
+
+        # LTTB needs numeric x values, so dates are converted to nanoseconds and categories to their positions. 
+        # we only use these for picking the points, the trace keeps its original x values 
+        if x.dtype.kind in 'iuf':
+            x_numeric = x
+        elif x.dtype.kind == 'M' or isinstance(x[0], date):
+            x_numeric = pd.to_datetime(x).to_numpy().astype('datetime64[ns]').astype(np.int64)
+        else:
+            x_numeric = np.arange(len(x))
+        keep = lttb(x_numeric, y, budget)
+        trace.x = x[keep]
+        trace.y = y[keep]
+
+    return fig
+
+
+def figure_payload_size(fig) -> int:
+    """
+    Function to measure how many bytes a plotly figure takes up when it gets sent to the browser
+
+    :param: fig - plotly figure 
+    :return: size of the serialized figure in bytes 
+    """
+    return len(fig.to_json().encode('utf-8'))
+
+
 def load_audio_features():
-    # TODO change this to reflect true path vvv
-    fpath: Path = ABSPATH_TO_DATA / 'audio_features' / 'audio_features_final.csv'
-    df: pd.DataFrame = pd.read_csv(fpath, sep=',')
+    df: pd.DataFrame = pd.read_csv(ABSPATH_TO_AUDIO_FEATURES, sep=',')
     return df
 
-# some test code 
-if __name__ == "__main__":
-    sd = SpotData()
+def write_synthetic_audio_features(streaming_history: pd.DataFrame, fpath: Path, seed: int = 0):
+    """
+    Function to write a made up audio features file in the same format as get_audio_features.py, so that the 
+    audio feature queries can be checked without calling the Spotify API 
 
-    print('something')
+    :param: streaming_history - pandas dataframe containing the streaming history 
+    :param: fpath - path to write the .csv file to 
+    :param: seed - seed for the random number generator 
+    :return: NA 
+    """
+    rng = np.random.default_rng(seed)
+    genres: list = ['indie pop', 'bubble grunge', 'jazz', 'bedroom pop', 'neo soul']
+
+    df: pd.DataFrame = streaming_history[['endTime', 'artistName', 'trackName', 'msPlayed', 'artist_and_song']].copy()
+    df['energy'] = rng.random(len(df))
+    df['loudness'] = -20.0 * rng.random(len(df))
+    df['danceability'] = rng.random(len(df))
+    # just like the real file, each play gets one row for each of its genres 
+    df['genres'] = [list(rng.choice(genres, size=rng.integers(1, 4), replace=False)) for _ in range(len(df))]
+    df = df.explode('genres')
+
+    df = df.sort_values(by=['endTime', 'artist_and_song'], ascending=True)
+    df.to_csv(fpath, sep=',')
+
+
+# some test code: check that both query backends give the same answers 
+if __name__ == "__main__":
+    import tempfile
+
+    # the audio features only exist after get_audio_features.py has been run, so we make some up if they are missing. 
+    # the temporary directory (and the parquet copy DuckDB writes next to the csv) is removed when we are done 
+    tmp_dir = tempfile.TemporaryDirectory()
+    if not ABSPATH_TO_AUDIO_FEATURES.exists():
+        ABSPATH_TO_AUDIO_FEATURES = Path(tmp_dir.name) / 'audio_features_final.csv'
+        write_synthetic_audio_features(SpotData(backend='pandas').streaming_history, ABSPATH_TO_AUDIO_FEATURES)
+
+    pandas_sd = SpotData(backend='pandas')
+    duckdb_sd = SpotData(backend='duckdb')
+
+    seasons: list = [[3, 4, 5], [6, 7, 8], [9, 10, 11], [12, 1, 2], list(range(1, 13))]
+
+    for season_months in seasons:
+        for key in ['artist_and_song', 'artistName']:
+            pd.testing.assert_frame_equal(pandas_sd.top_n(key, 10, season_months), 
+                                          duckdb_sd.top_n(key, 10, season_months), check_dtype=False)
+        pd.testing.assert_frame_equal(pandas_sd.listening_pattern(season_months), 
+                                      duckdb_sd.listening_pattern(season_months), check_dtype=False)
+        for threshold in [1000.0, 5000.0, 10000.0]:
+            pd.testing.assert_frame_equal(pandas_sd.taste(season_months, threshold), 
+                                          duckdb_sd.taste(season_months, threshold), check_dtype=False)
+        if ABSPATH_TO_SEARCH_QUERIES.exists():
+            for window_minutes in [5, 30, 120]:
+                pd.testing.assert_frame_equal(pandas_sd.search_conversions(season_months, window_minutes), 
+                                              duckdb_sd.search_conversions(season_months, window_minutes), check_dtype=False)
+
+        pd.testing.assert_frame_equal(pandas_sd.top_n('genres', 20, season_months, features=True), 
+                                      duckdb_sd.top_n('genres', 20, season_months, features=True), check_dtype=False)
+        for freq in ['D', 'W', 'M']:
+            for exclude_year in [None, 2022]:
+                pd.testing.assert_frame_equal(pandas_sd.feature_rollup(freq, season_months, exclude_year=exclude_year), 
+                                              duckdb_sd.feature_rollup(freq, season_months, exclude_year=exclude_year), 
+                                              check_freq=False)
+
+    # searches from the bundled MyData export and the plays they led to, each song started within a minute or two 
+    # of the search. "swole tru" -> Izzy True - Swole (177800 ms), "plastic" -> Tia Blake - Plastic Jesus (twice) 
+    known_conversions: dict = {'swole tru': 177800, 'plastic': 1671 + 143290}
+    if ABSPATH_TO_SEARCH_QUERIES.exists():
+        for sd in [pandas_sd, duckdb_sd]:
+            conversions_df = sd.search_conversions(list(range(1, 13)), window_minutes=3)
+            for search_query, ms_played in known_conversions.items():
+                if search_query in set(sd.search_queries()['searchQuery']):
+                    found: float = conversions_df.loc[conversions_df['searchQuery'] == search_query, 'msPlayed'].sum()
+                    assert found == ms_played, f'{sd.backend}: "{search_query}" led to {found} ms, expected {ms_played} ms'
+
+    tmp_dir.cleanup()
+    print('Both query backends return identical results.')
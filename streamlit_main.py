@@ -24,9 +24,13 @@ import plotly.express as px
 import plotly.graph_objects as go
 from sklearn.preprocessing import MinMaxScaler
 
-from routines import SpotData, load_audio_features
+from routines import SpotData, prepare_figure, figure_payload_size, ABSPATH_TO_SEARCH_QUERIES
 
 DASHBOARD_SIMPLE: bool = False
+QUERY_BACKEND: str = 'pandas'  # <-- set this to 'duckdb' for streaming histories that don't fit in memory
+CHART_WIDTH: int = 1350  # <-- width in pixels of a chart that fills the whole page, used for the point budget
+POINTS_PER_PIXEL: float = 2.0  # <-- lower this to send fewer points to slow browsers
+SHOW_PAYLOAD_SIZE: bool = False  # <-- set this to True to show how many kB each chart sends to the browser
 
 st.set_page_config(layout="wide")
 
@@ -43,66 +47,30 @@ season_mapper: dict = {
     'Winter Jams': [12, 1, 2], 
     'All Year Long': [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12]
 }
+season_months: list = season_mapper[season_selection]
 
 todays_date = date.today()
 curr_year = int(todays_date.year)  # <-- we will use this later 
 
-# read the data into memory 
-sd = SpotData()
-streaming_data = sd.streaming_history
-library = sd.library
+@st.experimental_singleton
+def load_spot_data(backend: str) -> SpotData:
+    # the data source is only set up once and then shared across every rerun of the dashboard 
+    return SpotData(backend=backend)
 
-# streaming data with audio features
-audio_features = load_audio_features() 
-
-# we need to convert the string datetime series to a pandas datetime column 
-streaming_data['date_filter'] = pd.to_datetime(streaming_data['endTime'], format='%Y-%m-%d %H:%M')  
-# and then we can filter the streaming data to only the season chosen by the user
-streaming_data = streaming_data[streaming_data['date_filter'].dt.month.isin(season_mapper[season_selection])]
-
-# we then repeat the process with the audio features that will be used in other charts 
-audio_features['date_filter'] = pd.to_datetime(audio_features['endTime'], format='%Y-%m-%d %H:%M')  
-audio_features = audio_features[audio_features['date_filter'].dt.month.isin(season_mapper[season_selection])]
-
-# we need to do this to fix a small bug with the line graph: 
-line_audio_features: pd.DataFrame = audio_features.copy()
-line_audio_features = line_audio_features[line_audio_features['date_filter'].dt.year != curr_year]
+# set up the data source, all the queries below are filtered to the season chosen by the user 
+sd = load_spot_data(QUERY_BACKEND)
 
 # --- get top songs ---
-top_songs_df = streaming_data.groupby(by=["artist_and_song"]).count().sort_values(by=['trackName'], ascending=False)
-top_songs_df['artist_and_song'] = top_songs_df.index
-top_songs_df = top_songs_df.reset_index(drop=True)
-top_songs_df = top_songs_df[['artist_and_song', 'endTime']].head(10)
-top_songs_df = top_songs_df.rename(columns={'endTime': 'Count'})
+top_songs_df = sd.top_n('artist_and_song', 10, season_months)
 
 # --- get top artists ---
-top_artist_df = streaming_data.groupby(by=["artistName"]).count().sort_values(by=['trackName'], ascending=False)
-top_artist_df['artist'] = top_artist_df.index
-top_artist_df = top_artist_df.reset_index(drop=True)
-top_artist_df = top_artist_df[['artist', 'endTime']].head(10)
-top_artist_df = top_artist_df.rename(columns={'endTime': 'Count'})
-
-# --- how well do you like your own taste in music? --- 
-good_taste_df = streaming_data[streaming_data['artist_and_song'].isin(library['artist_and_song'])]
-good_taste_df = good_taste_df[['msPlayed', 'artist_and_song']]
-grouped_taste_df = good_taste_df.groupby(['artist_and_song']).mean()
-grouped_taste_df = grouped_taste_df.sort_values(by='msPlayed', ascending=True)
-# here we want to exclude all the songs that were'nt played at all because they were never forcibly skipped 
-grouped_taste_df = grouped_taste_df[grouped_taste_df['msPlayed'] > 1000.0]
-grouped_taste_df['artist_and_song'] = grouped_taste_df.index
-grouped_taste_df = grouped_taste_df.head(20)
-
-
-l_df = streaming_data.copy()
-l_df.index = pd.to_datetime(l_df['endTime'], format='%Y-%m-%d %H:%M')  
-agg_15m = l_df.groupby(pd.Grouper(freq='15Min')).count()
-
-agg_15m['d_time'] = agg_15m.index
-agg_15m['time'] = agg_15m['d_time'].dt.time
-agg_15m = agg_15m[['msPlayed', 'time']]
+top_artist_df = sd.top_n('artistName', 10, season_months)
+top_artist_df = top_artist_df.rename(columns={'artistName': 'artist'})
 
+# --- get the daily listening pattern ---
+time_df: pd.DataFrame = sd.listening_pattern(season_months)
+time_df = time_df.set_index('time')
 # here we need to account for the time zone shift (roll back 5 hours)
-time_df: pd.DataFrame = agg_15m.groupby(['time']).sum()
 # convert time to datetimeime index 
 time_df.index = pd.to_datetime(time_df.index, format='%H:%M:%S')  
 # roll the time back by 5 hours
@@ -117,22 +85,10 @@ time_df = time_df[['msPlayed', 'time']]
 time_df = time_df.rename(columns={'msPlayed': 'Songs Played'})
 
 
-# --- get top genres --- 
-top_genres_df = audio_features.copy()
-top_genres_df = top_genres_df.groupby(by=["genres"]).count().sort_values(by=['trackName'], ascending=False)
-top_genres_df['genre'] = top_genres_df.index
-top_genres_df = top_genres_df.reset_index(drop=True)
-top_genres_df = top_genres_df[['genre', 'endTime']].head(20)
-top_genres_df = top_genres_df.rename(columns={'endTime': 'Count'})
-
 def create_fig_pie(num_slices: int):
     # --- get top genres --- 
-    top_genres_df = audio_features.copy()
-    top_genres_df = top_genres_df.groupby(by=["genres"]).count().sort_values(by=['trackName'], ascending=False)
-    top_genres_df['genre'] = top_genres_df.index
-    top_genres_df = top_genres_df.reset_index(drop=True)
-    top_genres_df = top_genres_df[['genre', 'endTime']].head(num_slices)
-    top_genres_df = top_genres_df.rename(columns={'endTime': 'Count'})
+    top_genres_df = sd.top_n('genres', num_slices, season_months, features=True)
+    top_genres_df = top_genres_df.rename(columns={'genres': 'genre'})
 
     pie_chart_padding: int = 75  # <-- increase this to make the pie chart smaller
     labels = list(top_genres_df['genre'])
@@ -163,14 +119,10 @@ def get_line_fig(time_agg: str):
     }
 
     # vvv we add this to fix a bug with the spring data
-    if season_selection == "Spring Tunes":
-        audio_feats_df = line_audio_features.copy()
-    else:
-        audio_feats_df = audio_features.copy()
+    exclude_year = curr_year if season_selection == "Spring Tunes" else None
 
     # --- group for attributes over time chart ---
-    audio_feats_df.index = pd.to_datetime(audio_feats_df['endTime'], format='%Y-%m-%d %H:%M')  
-    audio_feats_df = audio_feats_df.groupby(pd.Grouper(freq=time_agg_mapper[time_agg])).mean(numeric_only=True)
+    audio_feats_df = sd.feature_rollup(time_agg_mapper[time_agg], season_months, exclude_year=exclude_year)
     audio_feats_df['day'] = audio_feats_df.index
     audio_feats_df['day_dt'] = audio_feats_df['day'].dt.date
     audio_feats_df_to_scale = audio_feats_df[['energy', 'loudness', 'danceability']]
@@ -189,10 +141,10 @@ def get_line_fig(time_agg: str):
     audio_feats_df = pd.concat([audio_feats_df_no_scale, audio_feats_df_to_scale], axis=1)
     audio_feats_df = audio_feats_df.rename(columns={0: 'energy', 1: 'loudness', 2: 'danceability'})
 
-    date = list(audio_feats_df['day_dt'])
-    energy = list(audio_feats_df['energy'])
-    loudness = list(audio_feats_df['loudness'])
-    danceability = list(audio_feats_df['danceability'])
+    date = audio_feats_df['day_dt'].to_numpy()
+    energy = audio_feats_df['energy'].to_numpy()
+    loudness = audio_feats_df['loudness'].to_numpy()
+    danceability = audio_feats_df['danceability'].to_numpy()
     line_fig = go.Figure()
     line_fig.add_trace(go.Scatter(x=date, y=energy,
                         mode='lines',
@@ -221,20 +173,45 @@ def get_fig_music_taste(threshold: str):
     }
 
     # --- how well do you like your own taste in music? --- 
-    good_taste_df = streaming_data[streaming_data['artist_and_song'].isin(library['artist_and_song'])]
-    good_taste_df = good_taste_df[['msPlayed', 'artist_and_song']]
-    grouped_taste_df = good_taste_df.groupby(['artist_and_song']).mean()
-    grouped_taste_df = grouped_taste_df.sort_values(by='msPlayed', ascending=True)
-    # here we want to exclude all the songs that were'nt played at all because they were never forcibly skipped 
-    grouped_taste_df = grouped_taste_df[grouped_taste_df['msPlayed'] > threshold_mapper[threshold]]
-    grouped_taste_df['artist_and_song'] = grouped_taste_df.index
-    grouped_taste_df = grouped_taste_df.head(20)
+    grouped_taste_df = sd.taste(season_months, threshold_mapper[threshold], n=20)
 
     fig_music_taste = px.bar(grouped_taste_df, x='artist_and_song', y='msPlayed', width=800, height=650, 
              color='msPlayed', text_auto=True, title="Songs you thought you liked,but you actually hate", 
              color_continuous_scale=px.colors.sequential.Tealgrn)
 
     return fig_music_taste
+
+
+def get_fig_searches(conversions_df: pd.DataFrame):
+
+    # --- which searches turned into the most listening? --- 
+    searches_df = conversions_df.copy()
+    # group the same search typed in slightly different ways together 
+    searches_df['searchQuery'] = searches_df['searchQuery'].str.strip().str.lower()
+    searches_df = searches_df[searches_df['searchQuery'] != '']
+    searches_df = searches_df.groupby(['searchQuery'])['Plays'].sum().reset_index()
+    searches_df = searches_df.sort_values(by=['Plays', 'searchQuery'], ascending=[False, True]).head(20)
+
+    fig_searches = px.bar(searches_df, x='Plays', y='searchQuery', height=650, color='Plays', text_auto=True, 
+             title="Searches that turned into the most listening", orientation='h', 
+             color_continuous_scale=px.colors.sequential.Tealgrn)
+    fig_searches['layout']['yaxis']['autorange'] = "reversed"
+
+    return fig_searches
+
+
+def plot_chart(fig, width: int = CHART_WIDTH):
+    """
+    Function to downsample a plotly figure to the point budget for its width and display it in streamlit
+
+    :param: fig - plotly figure 
+    :param: width - width of the chart in pixels 
+    """
+    fig = prepare_figure(fig, width=width, points_per_pixel=POINTS_PER_PIXEL)
+    st.plotly_chart(fig, use_container_width=True)
+
+    if SHOW_PAYLOAD_SIZE:
+        st.caption(f'Chart payload: {figure_payload_size(fig) / 1024:.1f} kB')
     
 
 # ----- PLOTLY -----
@@ -275,11 +252,11 @@ col1, col2= st.columns(2)
 
 with col1:
     st.header("Top Songs")
-    st.plotly_chart(fig_bar_songs, use_container_width=True)
+    plot_chart(fig_bar_songs, width=CHART_WIDTH // 2)
 
 with col2:
     st.header("Top Artists")
-    st.plotly_chart(fig_bar_artists, use_container_width=True)
+    plot_chart(fig_bar_artists, width=CHART_WIDTH // 2)
 
 if not DASHBOARD_SIMPLE:
     # here we only display the Energy, Loudness, & Danceability attributes if the dashboard is NOT set to simple
@@ -294,7 +271,7 @@ if not DASHBOARD_SIMPLE:
     st.write(f'You selected **{time_agg}**, feel free to try other time aggregations for the listener\'s energy, loudness, and danceability.')
 
     line_fig = get_line_fig(time_agg=time_agg)
-    st.plotly_chart(line_fig, use_container_width=True)
+    plot_chart(line_fig)
 
 
 if DASHBOARD_SIMPLE:
@@ -302,7 +279,7 @@ if DASHBOARD_SIMPLE:
     st.header("Daily Listening Pattern")
     st.markdown('We can now look at the listening pattern throughout the day! Do you like to \
 listen to music in the morning? In the evening? Perhaps a podcast over lunch? Let\'s find out.', unsafe_allow_html=False)
-    st.plotly_chart(fig_bar_listening, use_container_width=True)
+    plot_chart(fig_bar_listening)
 else:
     # for the complex version of the dashbaord, we also include a pie chart showing the listener's genres
     col1, col2 = st.columns(2)
@@ -312,7 +289,7 @@ else:
         st.markdown('We can now look at the listening pattern throughout the day! Do you like to \
     listen to music in the morning? In the evening? Perhaps a podcast over lunch? Let\'s find out.', unsafe_allow_html=False)
         
-        st.plotly_chart(fig_bar_listening, use_container_width=True)
+        plot_chart(fig_bar_listening, width=CHART_WIDTH // 2)
 
     with col2:
         st.header("Top Genres")
@@ -323,7 +300,7 @@ else:
             options=list(range(5, 50)))
 
         fig_pie = create_fig_pie(num_slices=num_slices)
-        st.plotly_chart(fig_pie, use_container_width=True)
+        plot_chart(fig_pie, width=CHART_WIDTH // 2)
 
 st.markdown('''
 # How Well Do I Like My Own Taste in Music? 
@@ -341,7 +318,29 @@ threshold = st.radio(
      'I can\'t decide... Skip after at least ten seconds.'))
 
 fig_music_taste = get_fig_music_taste(threshold=threshold)
-st.plotly_chart(fig_music_taste, use_container_width=True)
+plot_chart(fig_music_taste)
+
+if ABSPATH_TO_SEARCH_QUERIES.exists():
+    # not every Spotify export includes SearchQueries.json, so we only show this section if the file is there
+    st.markdown('''
+    # Searches That Turned Into Listening
+    Not every search ends with a song being played. This section links each song played to the last search made shortly before it started, 
+    so we can see which searches actually converted into listening and which ones were abandoned. 
+    ''', unsafe_allow_html=False)
+
+    search_window: int = st.select_slider(
+        'How many minutes after a search should a song still count towards it?',
+        options=[5, 10, 15, 30, 60, 120], value=30)
+
+    searches_df = sd.search_queries()
+    conversions_df = sd.search_conversions(season_months, window_minutes=search_window)
+    season_searches = searches_df[searches_df['searchTime'].dt.month.isin(season_months)]
+    st.write(f'**{len(conversions_df)}** of the listener\'s **{len(season_searches)}** searches were followed by \
+listening within {search_window} minutes.')
+
+    fig_searches = get_fig_searches(conversions_df)
+    plot_chart(fig_searches)
+    st.dataframe(conversions_df)
 
 st.markdown(""" 
 ## References